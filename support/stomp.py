@@ -2,13 +2,31 @@
 Implementation of the STOMP (Streaming/Simple Text Oriented Message Protocol).
 
 Used at PayPal for YAM, LAR, and possibly other message systems.
+
+PERFORMANCE NOTES
+
+Framing STOMP is bound by syscalls and memory copies, not by compute;
+SIMD, GPU offload and similar proposals do not apply.  The work that
+pays off here, in rough order:
+
+- fewer syscalls and copies: one recv() feeds FrameParser, which can
+  yield many frames, and queued frames are written in batched sendall()
+  calls (no MSG_PEEK, no re-reading of consumed bytes)
+- scanning in C: delimiters are found with bytearray.find and headers
+  split with str.split/str.partition, builtins that already run in C,
+  so no compiled extension is needed
+- avoiding per-frame interpreter work: prebuilt command lines, header
+  prefixes and constant ACK/DISCONNECT frames, a handler table for
+  received frames, and log-level checks before per-frame debug logging
+- data layout: commands, headers and bodies stay bytes from socket to
+  socket, and are never decoded
 '''
 import collections
 import weakref
 import random
 
 from gevent import socket
-import gevent.queue
+import gevent.event
 
 import context
 import async
@@ -37,8 +55,12 @@ class Connection(object):
         self.on_message = on_message
         self.on_reciept = on_reciept
         self.on_error = on_error
-        self.send_q = gevent.queue.Queue()
+        # Frames (or constant, already serialized frames) waiting for
+        # _run_send; send_evt is set whenever one is added
+        self.send_q = collections.deque()
+        self.send_evt = gevent.event.Event()
         self.sock = None
+        self.parser = None
         # a bit of indirection for closing sock after GC
         self.sock_container = [self.sock]
         self.sock_ready = gevent.event.Event()
@@ -57,13 +79,17 @@ class Connection(object):
         self.no_receipt = set()  # send ids for which there was no receipt
         self.start()
 
-    def send(self, destination, body="", extra_headers=None):
+    def send(self, destination, body=b"", extra_headers=None):
+        if isinstance(body, unicode):
+            # encode once here; frames carry bytes from here on
+            body = body.encode('utf-8')
+        msg_id = self.msg_id
+        self.msg_id = msg_id + 1
+        self.no_receipt.add(msg_id)
         headers = {
             "destination": destination,
-            "receipt": self.msg_id
+            "receipt": _ITOA.get(msg_id) or str(msg_id)
         }
-        self.no_receipt.add(self.msg_id)
-        self.msg_id += 1
         # NOTE: STOMP 1.0, no content-type
         # if body:
         #     headers['content-type'] = 'text/plain'
@@ -71,14 +97,14 @@ class Connection(object):
             headers.update(extra_headers)
         log_rec = context.get_context().log.info('STOMP', 'ENQUEUE')
         log_rec.success(length=len(body))
-        self.send_q.put(Frame("SEND", headers, body))
+        self._enqueue(Frame._unchecked("SEND", headers, body))
 
     def subscribe(self, destination):
         self.sub_id += 1
         headers = {'subscription': destination,
-                   'id': self.sub_id,
+                   'id': _ITOA.get(self.sub_id) or str(self.sub_id),
                    'ack': 'auto'}
-        self.send_q.put(Frame("SUBSCRIBE", headers))
+        self._enqueue(Frame._unchecked("SUBSCRIBE", headers))
 
     def unsubscribe(self):
         raise NotImplementedError("IOU subscriptions")
@@ -99,7 +125,7 @@ class Connection(object):
         raise NotImplementedError("handled implicitly")
 
     def disconnect(self, timeout=10):
-        self.send_q.put(Frame("DISCONNECT", {}))
+        self._enqueue(_DISCONNECT_BYTES)
         # wait for a reciept from server acknowledging disconnect
         self.wait("RECEIPT")
 
@@ -108,7 +134,7 @@ class Connection(object):
         Send a raw Frame.  Warning -- this may break the STOMP state.
         As a simple example, a DISCONNECT frame could be sent this way.
         '''
-        self.send_q.put(frame)
+        self._enqueue(frame)
 
     def start(self):
         if self.started:
@@ -136,6 +162,10 @@ class Connection(object):
         '''
         pass
 
+    def _enqueue(self, frame):
+        self.send_q.append(frame)
+        self.send_evt.set()
+
     def _reconnect(self):
         if self.sock:
             async.killsock(self.sock)
@@ -143,36 +173,79 @@ class Connection(object):
         self.sock = ctx.get_connection(self.address, ssl=self.ssl)
         self.sock_broken.clear()
         self.sock_container[0] = self.sock
+        self.parser = FrameParser()
         headers = {"login": self.login, "passcode": self.passcode}
-        self.sock.sendall(Frame("CONNECT", headers).serialize())
-        resp = Frame.parse_from_socket(self.sock)
-        if resp.command != "CONNECTED":
+        self.sock.sendall(Frame._unchecked("CONNECT", headers).serialize())
+        frames = []
+        while not frames:
+            frames = [cur for cur in self.parser.feed(_recv_or_raise(self.sock))
+                      if cur is not _HEARTBEAT]
+        resp = frames[0]
+        if resp.command != b'CONNECTED':
             raise ValueError("Expected CONNECTED frame from server, got: %r"
                              % repr(resp))
-        self.session = resp.headers['session']
-        self.server_info = resp.headers.get('server')
+        self.session = resp.headers[b'session']
+        self.server_info = resp.headers.get(b'server')
         ml.ld2("reconn clearing sock broken")
         self.sock_broken.clear()
+        # anything the server sent right behind CONNECTED
+        for cur in frames[1:]:
+            _RECV_HANDLERS.get(cur.command, _on_ignored)(self, cur)
         ml.ld2("reconn setting sock ready")
         self.sock_ready.set()
         # once sock_ready.set() happens, others will resume execution
 
 
+# maximum number of queued frames written with a single sendall()
+_SEND_BATCH_SIZE = 32
+
+# bytes requested per recv(); large enough that a busy subscription
+# gets many frames per syscall
+_RECV_SIZE = 65536
+
+
 # these are essentially methods of the Connection class; they are
 # broken out to regular functions so that bound methods in greenlet
 # call stacks do not interfere with garbage collection
 def _run_send(self):
+    # the queue and its event live as long as the connection and hold no
+    # reference back to it, so binding them here does not keep self alive
+    send_q, send_evt = self.send_q, self.send_evt
     ml.ld2("run send Waiting for sock ready")
     self.sock_ready.wait()
+    # frames dequeued but not yet written; kept across a socket error
+    # so that they are resent once the connection is re-established
+    serial_batch, batch_len = None, 0
     while not self.stopping:
         stomp_log = context.get_context().log.get_logger('STOMP')
         try:
-            cur = self.send_q.peek()
-            serial_cur = cur.serialize()
-            ml.ld2("Lar sender dequed {{{0}}}", serial_cur)
-            self.sock.sendall(serial_cur)
-            stomp_log.info("DEQUEUE").success(length=len(serial_cur))
-            self.send_q.get()
+            if serial_batch is None:
+                while not send_q:
+                    send_evt.clear()
+                    send_evt.wait()
+                serial_frames = []
+                for _ in xrange(min(len(send_q), _SEND_BATCH_SIZE)):
+                    cur = send_q.popleft()
+                    if isinstance(cur, bytes):
+                        serial_frames.append(cur)
+                        continue
+                    try:
+                        serial_frames.append(cur.serialize())
+                    except Exception as e:
+                        # drop only the bad frame; the rest still go out
+                        ml.ld2("Got exception {0!r}", e)
+                        stomp_log.critical("EXCEPTION").failure(
+                            exc=repr(e), green='send', frame=repr(cur)[:100])
+                if not serial_frames:
+                    continue
+                serial_batch = b''.join(serial_frames)
+                batch_len = len(serial_frames)
+            if ll.get_log_level() >= ll.LOG_LEVELS['DEBUG2']:
+                ml.ld2("Lar sender dequed {{{0}}}", serial_batch)
+            self.sock.sendall(serial_batch)
+            stomp_log.info("DEQUEUE").success(length=len(serial_batch),
+                                              frames=batch_len)
+            serial_batch = None
         except socket.error as e:
             stomp_log.critical("EXCEPTION").failure(exc=repr(e), green='send')
             ml.ld2("Got exception {0!r}", e)
@@ -187,32 +260,24 @@ def _run_send(self):
 
 def _run_recv(self):
     ml.ld2("run recv waiting for sock ready")
+    get_handler = _RECV_HANDLERS.get
     self.sock_ready.wait()
     while not self.stopping:
         try:
-            cur = Frame.parse_from_socket(self.sock)
-            ml.ld2("rec recv Lar recver got {0!r}", cur)
-            if cur.command == 'HEARTBEAT':
-                # discard
-                pass
-            # print "GOT", cur.command, "\n", cur.headers, "\n", cur.body
-            if cur.command == "MESSAGE":
-                if 'ack' in cur.headers:
-                    ack = Frame("ACK", {})
-                    self.send_q.put(ack)
-            if cur.command == 'RECEIPT':
-                if cur.headers.get('receipt-id') in self.no_receipt:
-                    self.no_receipt.remove(cur.headers.get('receipt-id'))
-            if cur.command == 'ERROR':
-                pass
-
+            for cur in self.parser.feed(_recv_or_raise(self.sock)):
+                if ll.get_log_level() >= ll.LOG_LEVELS['DEBUG2']:
+                    ml.ld2("rec recv Lar recver got {0!r}", cur)
+                get_handler(cur.command, _on_ignored)(self, cur)
         except socket.timeout as e:
             ml.ld2("Got exception {0!r}", e)
             pass  # expected if no traffic
-        except socket.error as e:
+        except (socket.error, ValueError) as e:
+            # a ValueError is a malformed frame; the stream can no longer
+            # be trusted, so drop what is buffered and reconnect
             ml.ld2("Got exception {0!r}", e)
             stomp_log = context.get_context().log.get_logger('STOMP')
             stomp_log.critical("EXCEPTION").failure(exc=repr(e), green='recv')
+            self.parser = FrameParser()
             # wait for socket to be ready again
             ml.ld2("run recv clearing sock ready")
             self.sock_ready.clear()
@@ -222,6 +287,33 @@ def _run_recv(self):
             self.sock_ready.wait()
 
 
+# handlers for frames received by _run_recv, keyed by command
+def _on_message(self, frame):
+    if b'ack' in frame.headers:
+        self._enqueue(_ACK_BYTES)
+
+
+def _on_receipt(self, frame):
+    # receipt-id comes back as raw bytes; no_receipt holds ints
+    rid = frame.headers.get(b'receipt-id')
+    if rid is not None:
+        try:
+            self.no_receipt.discard(int(rid))
+        except ValueError:
+            pass
+
+
+def _on_ignored(self, frame):
+    # HEARTBEAT, ERROR, and anything unexpected are discarded
+    pass
+
+
+_RECV_HANDLERS = {b'HEARTBEAT': _on_ignored,
+                  b'MESSAGE': _on_message,
+                  b'RECEIPT': _on_receipt,
+                  b'ERROR': _on_ignored}
+
+
 def _run_socket_fixer(self):
     last_time = 0.1
     while not self.stopping:
@@ -235,132 +327,215 @@ def _run_socket_fixer(self):
             stomp_log = context.get_context().log.get_logger('STOMP')
             stomp_log.critical("EXCEPTION").failure(exc=repr(e), green='fixer')
             gevent.sleep(last_time + random.random())
-            if last_time < 300 and self.send_q.qsize() == 0:
+            if last_time < 300 and not self.send_q:
                 last_time = last_time * 2.0
             else:
                 last_time = 0.1
 
 
+def _recv_or_raise(sock):
+    data = sock.recv(_RECV_SIZE)
+    if not data:
+        raise socket.error("STOMP connection closed by peer")
+    return data
+
+
 def _killsock_later(sock_container):
     return lambda weak: async.killsock(sock_container[0])
 
 
-CLIENT_CMDS = set(["SEND", "SUBSCRIBE", "UNSUBSCRIBE", "BEGIN", "COMMIT",
-                   "ABORT", "ACK", "NACK", "DISCONNECT", "CONNECT", "STOMP"])
+CLIENT_CMDS = frozenset([b'SEND', b'SUBSCRIBE', b'UNSUBSCRIBE', b'BEGIN',
+                         b'COMMIT', b'ABORT', b'ACK', b'NACK', b'DISCONNECT',
+                         b'CONNECT', b'STOMP'])
 
-SERVER_CMDS = set(["CONNECTED", "MESSAGE", "RECEIPT", "ERROR"])
+SERVER_CMDS = frozenset([b'CONNECTED', b'MESSAGE', b'RECEIPT', b'ERROR'])
 
 ALL_CMDS = CLIENT_CMDS | SERVER_CMDS
 
+_COLON = b':'
+_NL = b'\n'
+_NUL = b'\0'
+_CONTENT_LENGTH_HDR = b'content-length:'
+
+# ACK and DISCONNECT are always sent without headers or body, so they
+# are queued already serialized
+_ACK_BYTES = b'ACK\n\n\0'
+_DISCONNECT_BYTES = b'DISCONNECT\n\n\0'
+
+# string forms of small receipt and subscription ids, which cover most
+# connection lifetimes
+_ITOA = {i: str(i) for i in range(1024)}
+
+# "COMMAND\n" lines and "name:" header prefixes built once, so that
+# serialize() needs a single extend() for each
+_CMD_LINES = {cmd: cmd + _NL for cmd in ALL_CMDS}
+_HDR_PREFIXES = {k: k + _COLON for k in (
+    'destination', 'receipt', 'subscription', 'id', 'ack',
+    'login', 'passcode', 'content-length')}
+
 
-class Frame(collections.namedtuple("STOMP_Frame", "command headers body")):
-    def __new__(cls, command, headers, body=""):
+class Frame(object):
+    __slots__ = ('command', 'headers', 'body')
+
+    def __init__(self, command, headers, body=b""):
         if command not in ALL_CMDS:
             raise ValueError("invalid STOMP command: " + repr(command) +
                 " (valid commands are " + ", ".join([repr(c) for c in ALL_CMDS]) + ")")
-        return super(cls, Frame).__new__(cls, command, headers, body)
-
-    def serialize(self):
-        if self.body and 'content-length' not in self.headers:
-            self.headers['content-length'] = len(self.body)
-        return (self.command + '\n' + '\n'.join(
-            ['{0}:{1}'.format(k, v) for k,v in self.headers.items()])
-            + '\n\n' + self.body + '\0')
+        self.command = command
+        self.headers = headers
+        self.body = body
 
     @classmethod
-    def _parse_iter(cls):
+    def _unchecked(cls, command, headers, body=b""):
         '''
-        parse data in an iterator fashion;
-        this is intended to allow clean separation of socket
-        code from protocol code
+        construct a Frame without validating command; only for frames
+        built internally from one of the command literals above
         '''
-        data = ""
-        consumed = 0
-        # clear between-message newlines
-        while not data:
-            data = yield None, consumed
-            consumed = len(data) - len(data.lstrip('\n'))
-            data = data[consumed:]
-        # check for heartbeat
-        if data[0] == '\x0a':
-            yield cls('HEARTBEAT', None), consumed + 1
-        # parse command
-        sofar = []
-        while '\n' not in data:
-            consumed += len(data)
-            sofar.append(data)
-            data = yield None, consumed
-            consumed = 0
-        end, _, data = data.partition('\n')
-        consumed += len(end) + len(_)
-        sofar.append(end)
-        command = ''.join(sofar)
-        # parse headers
-        headers = {}
-        sofar = []
-        while '\n\n' not in data:
-            sofar.append(data)
-            consumed += len(data)
-            data = yield None, consumed
-            consumed = 0
-        sofar.append(data)
-        data = ''.join(sofar)
-        header_str, _, data = data.partition('\n\n')
-        consumed += len(header_str) + len(_)
-        for cur_header in header_str.split('\n'):
-            key, _, value = cur_header.partition(':')
-            headers[key] = value
-        # parse body
-        sofar = []
-        if 'content-length' in headers:
-            bytes_to_go = headers['content-length'] + 1
-            while len(data) - consumed < bytes_to_go:
-                sofar.append(data)
-                consumed += len(data)
-                bytes_to_go -= len(data)
-                data = yield None, consumed
-                consumed = 0
-            end_of_body, leftover = data[:bytes_to_go], data[bytes_to_go:]
-            if end_of_body[-1] != '\0':
-                raise ValueError('Frame not terminated with null byte.')
-            consumed += len(end_of_body)
-            end_of_body = end_of_body[:-1]
-        else:
-            while '\0' not in data:
-                sofar.append(data)
-                consumed += len(data)
-                data = yield None, consumed
-                consumed = 0
-            end_of_body, _, leftover = data.partition('\0')
-            consumed += len(end_of_body) + len(_)
-        sofar.append(end_of_body)
-        body = ''.join(sofar)
-        yield Frame(command, headers, body), consumed
-        raise StopIteration()
+        assert isinstance(body, bytes), "Frame body must be bytes"
+        frame = object.__new__(cls)
+        frame.command = command
+        frame.headers = headers
+        frame.body = body
+        return frame
+
+    def __repr__(self):
+        return '{0}(command={1!r}, headers={2!r}, body={3!r})'.format(
+            self.__class__.__name__, self.command, self.headers, self.body)
+
+    def __eq__(self, other):
+        if not isinstance(other, Frame):
+            return NotImplemented
+        return (self.command == other.command and
+                self.headers == other.headers and self.body == other.body)
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    def serialize(self):
+        # bytearray.extend() rejects unicode, so names, values and the
+        # command all go through str() and a text body is encoded here
+        command = self.command
+        buf = bytearray(_CMD_LINES.get(command) or str(command) + _NL)
+        buf_extend = buf.extend
+        headers = self.headers
+        for k, v in headers.items():
+            buf_extend(_HDR_PREFIXES.get(k) or str(k) + _COLON)
+            buf_extend(str(v))
+            buf_extend(_NL)
+        body = self.body
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        # content-length is computed inline rather than stored in
+        # self.headers, which may be shared with the caller
+        if body and 'content-length' not in headers:
+            buf_extend(_CONTENT_LENGTH_HDR)
+            buf_extend(str(len(body)))
+            buf_extend(_NL)
+        buf_extend(_NL)
+        buf_extend(body)
+        buf_extend(_NUL)
+        return bytes(buf)
 
     @classmethod
     def parse(cls, data):
-        parser = cls._parse_iter()
-        parser.next()
-        frame, bytes_consumed = parser.send(data)
-        if bytes_consumed != len(data):
-            raise ValueError("Excess data passed to stomp.Frame.parse(): "
-                             + repr(data[bytes_consumed:])[:100])
-        if frame is None:
+        parser = FrameParser()
+        frames = [f for f in parser.feed(data) if f is not _HEARTBEAT]
+        if not frames:
             raise ValueError("Incomplete frame passed to stomp.Frame.parse(): "
-                             "Consumed {0} bytes.".format(bytes_consumed))
-        return frame
+                             "{0} bytes buffered.".format(len(parser.buf)))
+        if len(frames) > 1 or parser.buf:
+            raise ValueError("Excess data passed to stomp.Frame.parse(): "
+                             + repr(data)[:100])
+        return frames[0]
 
-    @classmethod
-    def parse_from_socket(cls, sock):
-        parser = cls._parse_iter()
-        parser.next()
-        cur_data = sock.recv(4096, socket.MSG_PEEK)
-        frame, bytes_consumed = parser.send(cur_data)
-        while frame is None:
-            sock.recv(bytes_consumed)  # throw away consumed data
-            cur_data = sock.recv(4096, socket.MSG_PEEK)
-            frame, bytes_consumed = parser.send(cur_data)
-        sock.recv(bytes_consumed)  # throw away consumed data
-        ml.ld2("returning {0} from  parse from socket", bytes_consumed)
-        return frame
+
+# heartbeats are not a real STOMP command, so skip the validation in __init__
+_HEARTBEAT = Frame._unchecked(b'HEARTBEAT', {})
+
+_NL_ORD = ord(_NL)
+
+
+class FrameParser(object):
+    '''
+    Incremental STOMP frame parser.  Data read from the socket is passed
+    to feed(), which returns any frames it completed; a trailing partial
+    frame is buffered until the rest of it arrives.
+
+    This keeps socket code separate from protocol code, and lets a
+    single recv() yield several frames.  Commands, headers and bodies
+    are left as the raw bytes read off the wire; nothing is decoded.
+    '''
+    __slots__ = ('buf', 'pending')
+
+    def __init__(self):
+        self.buf = bytearray()
+        # (command, headers, body_start, body_len) of a frame whose
+        # headers have been parsed but whose body has not fully arrived
+        self.pending = None
+
+    def feed(self, data):
+        # slices are copied out through short-lived memoryviews, which copy
+        # once where bytes(buf[a:b]) would copy twice; no view may outlive
+        # a statement, since buf cannot be resized while one exists
+        buf = self.buf
+        buf.extend(data)
+        end = len(buf)
+        frames = []
+        pos = 0
+        pending, self.pending = self.pending, None
+        try:
+            while pos < end:
+                if pending:
+                    command, headers, body_start, body_len = pending
+                    pending = None
+                    # the terminator was not in the data already buffered
+                    scan_start = end - len(data)
+                else:
+                    # newlines between frames are heartbeats
+                    if buf[pos] == _NL_ORD:
+                        frames.append(_HEARTBEAT)
+                        pos += 1
+                        continue
+                    header_end = buf.find(b'\n\n', pos)
+                    if header_end < 0:
+                        break
+                    lines = memoryview(buf)[pos:header_end].tobytes()
+                    lines = lines.split(_NL)
+                    command = lines[0]
+                    headers = dict(h.partition(_COLON)[::2]
+                                   for h in lines[1:] if h)
+                    body_start = scan_start = header_end + 2
+                    try:
+                        body_len = int(headers.get(b'content-length', -1))
+                    except ValueError:
+                        raise ValueError('Invalid content-length header: '
+                                         + repr(headers[b'content-length']))
+                if body_len >= 0:
+                    body_end = body_start + body_len
+                    if body_end >= end:
+                        pending = (command, headers, body_start, body_len)
+                        break
+                    if buf[body_end] != 0:
+                        raise ValueError('Frame not terminated with null '
+                                         'byte.')
+                else:
+                    body_end = buf.find(_NUL, scan_start)
+                    if body_end < 0:
+                        pending = (command, headers, body_start, body_len)
+                        break
+                body = memoryview(buf)[body_start:body_end].tobytes()
+                frames.append(Frame(command, headers, body))
+                pos = body_end + 1
+        except ValueError:
+            # frames completed before the bad one are still returned; the
+            # bad frame stays at the head of buf, so the next feed() call
+            # raises again
+            if not frames:
+                raise
+        if pos:
+            del buf[:pos]
+        if pending:
+            command, headers, body_start, body_len = pending
+            self.pending = (command, headers, body_start - pos, body_len)
+        return frames
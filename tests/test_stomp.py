@@ -0,0 +1,120 @@
+import pytest
+
+from support import stomp
+from support.stomp import Frame, FrameParser
+
+
+MSG = Frame('MESSAGE', {'destination': '/queue/a', 'message-id': '7'},
+            'hello')
+BINARY = Frame('MESSAGE', {'content-length': '7'}, 'ab\0cd\0e')
+NO_LENGTH = 'RECEIPT\nreceipt-id:3\n\n\0'
+
+
+def feed_in_chunks(data, size):
+    parser = FrameParser()
+    frames = []
+    for i in range(0, len(data), size):
+        frames.extend(parser.feed(data[i:i + size]))
+    assert not parser.buf
+    assert parser.pending is None
+    return frames
+
+
+def test_serialize_parse_round_trip():
+    headers = {'destination': '/queue/a', 'receipt': '1'}
+    frame = Frame('SEND', headers, 'payload')
+    assert Frame.parse(frame.serialize()) == Frame(
+        'SEND', dict(headers, **{'content-length': '7'}), 'payload')
+    assert 'content-length' not in headers  # caller's dict left alone
+
+
+def test_feed_byte_at_a_time_and_chunked():
+    data = MSG.serialize() + BINARY.serialize() + NO_LENGTH
+    expected = [Frame.parse(MSG.serialize()), BINARY,
+                Frame('RECEIPT', {'receipt-id': '3'})]
+    for size in (1, 2, 3, 7, 64, len(data)):
+        assert feed_in_chunks(data, size) == expected
+
+
+def test_content_length_body_with_nul_bytes():
+    frame = Frame.parse(BINARY.serialize())
+    assert frame.body == 'ab\0cd\0e'
+
+
+def test_frame_without_content_length():
+    frame = Frame.parse(NO_LENGTH)
+    assert frame.command == 'RECEIPT'
+    assert frame.headers == {'receipt-id': '3'}
+    assert frame.body == ''
+
+
+def test_newlines_between_frames_are_heartbeats():
+    frames = FrameParser().feed('\n' + NO_LENGTH + '\n\n' + NO_LENGTH)
+    assert [f.command for f in frames] == [
+        'HEARTBEAT', 'RECEIPT', 'HEARTBEAT', 'HEARTBEAT', 'RECEIPT']
+
+
+def test_parse_excess_data():
+    with pytest.raises(ValueError):
+        Frame.parse(NO_LENGTH + NO_LENGTH)
+    with pytest.raises(ValueError):
+        Frame.parse(NO_LENGTH + 'REC')
+
+
+def test_parse_incomplete_data():
+    with pytest.raises(ValueError):
+        Frame.parse(NO_LENGTH[:-1])
+    with pytest.raises(ValueError):
+        Frame.parse(BINARY.serialize()[:-3])
+
+
+def test_content_length_body_over_several_feeds():
+    parser = FrameParser()
+    data = BINARY.serialize()
+    header_len = data.index('\n\n') + 2
+    assert parser.feed(data[:header_len + 2]) == []
+    assert parser.pending is not None
+    assert parser.feed(data[header_len + 2:-1]) == []
+    assert parser.feed(data[-1:]) == [BINARY]
+    assert parser.pending is None
+    assert not parser.buf
+
+
+def test_nul_terminated_body_over_several_feeds():
+    parser = FrameParser()
+    assert parser.feed('MESSAGE\na:b\n\nfir') == []
+    assert parser.pending is not None
+    assert parser.feed('st ') == []
+    assert parser.feed('second\0' + NO_LENGTH[:4]) == [
+        Frame('MESSAGE', {'a': 'b'}, 'first second')]
+    assert parser.feed(NO_LENGTH[4:]) == [Frame.parse(NO_LENGTH)]
+    assert parser.pending is None
+    assert not parser.buf
+
+
+def test_zero_content_length_before_terminator():
+    parser = FrameParser()
+    assert parser.feed('RECEIPT\ncontent-length:0\n\n') == []
+    assert parser.pending is not None
+    assert parser.feed('\0') == [Frame('RECEIPT', {'content-length': '0'})]
+    assert parser.pending is None
+    assert not parser.buf
+
+
+class _ReceiptTracker(object):
+    # stands in for a Connection; _on_receipt only touches no_receipt
+    def __init__(self, *msg_ids):
+        self.no_receipt = set(msg_ids)
+
+
+def test_receipt_clears_pending_msg_id():
+    conn = _ReceiptTracker(3, 4)
+    stomp._on_receipt(conn, Frame.parse(NO_LENGTH))
+    assert conn.no_receipt == set([4])
+
+
+def test_receipt_with_non_numeric_id_is_ignored():
+    conn = _ReceiptTracker(3)
+    stomp._on_receipt(conn, Frame('RECEIPT', {'receipt-id': 'abc'}))
+    stomp._on_receipt(conn, Frame('RECEIPT', {}))
+    assert conn.no_receipt == set([3])